@@ -32,8 +32,11 @@ def parse_arguments():
         "-m",
         "--minimum-area",
         type=int,
-        default=1000,
-        help="Minimum area for change before motion is detected.",
+        default=2500,
+        help=(
+            "Minimum area for change before motion is detected, in pixels of "
+            "the quarter-size frame."
+        ),
     )
 
     parser.add_argument(
@@ -79,6 +82,7 @@ if __name__ == "__main__":
         output_path=opts.path,
         recording_length=opts.recording_length,
         detection_wait=opts.detection_wait,
+        minimum_area=opts.minimum_area,
     )
 
     manager.camera.exposure(enable=(not opts.disable_exposure))
@@ -0,0 +1,100 @@
+"""
+Compiled kernels for the hot per-pixel loops of the motion detection.
+
+The kernels are called from both the preprocessing and detection threads at
+once, so none of them use `parallel=True`. Numba's `workqueue` threading
+layer, which is used whenever neither TBB nor OpenMP is installed, aborts the
+process on concurrent use, and for images this small the parallel loops were
+no faster anyway.
+"""
+
+import numpy
+from numba import njit
+
+
+@njit(fastmath=True, boundscheck=False, cache=True)
+def motion_score(a: numpy.ndarray, b: numpy.ndarray, threshold: int) -> int:
+    """
+    Count the pixels that differ by more than `threshold` between two greyscale
+    images. Does the absolute difference, threshold and count in a single pass
+    over the images rather than one pass each.
+
+    Parameters
+    ----------
+    a : numpy.ndarray
+        the first image.
+
+    b : numpy.ndarray
+        the second image, the same shape as `a`.
+
+    threshold : int
+        how much a pixel has to change by to be counted.
+
+    Returns
+    -------
+    int
+        the number of changed pixels.
+    """
+    count = 0
+
+    for i in range(a.shape[0]):
+        row_a = a[i]
+        row_b = b[i]
+
+        for j in range(a.shape[1]):
+            # Subtract the smaller value from the larger, since the pixels are
+            # unsigned and would otherwise wrap around.
+            x, y = row_a[j], row_b[j]
+            delta = x - y if x > y else y - x
+
+            if delta > threshold:
+                count += 1
+
+    return count
+
+
+@njit(fastmath=True, boundscheck=False, cache=True)
+def resize4_bgr2grey(src: numpy.ndarray, dst: numpy.ndarray) -> None:
+    """
+    Shrink a BGR image to a quarter of its size and greyscale it in a single
+    pass. Each 4x4 block of the source is averaged into one pixel, with the
+    same weights as `cv2.COLOR_BGR2GRAY`.
+
+    Parameters
+    ----------
+    src : numpy.ndarray
+        the BGR image to shrink.
+
+    dst : numpy.ndarray
+        the greyscale image to write into, a quarter of the width and height
+        of `src`.
+    """
+    for y in range(dst.shape[0]):
+        for x in range(dst.shape[1]):
+            b = 0
+            g = 0
+            r = 0
+
+            for j in range(4):
+                row = src[4 * y + j]
+
+                for i in range(4):
+                    pixel = row[4 * x + i]
+                    b += pixel[0]
+                    g += pixel[1]
+                    r += pixel[2]
+
+            # The weights are scaled up by 256 to stay in integers, and the sum
+            # covers 16 pixels, so shift back down by 12 bits, rounding.
+            dst[y, x] = (29 * b + 150 * g + 77 * r + 2048) >> 12
+
+
+def warm_up() -> None:
+    """
+    Compile all of the kernels ahead of time, so that the first frames don't
+    have to wait on them.
+    """
+    grey = numpy.zeros((1, 1), dtype=numpy.uint8)
+
+    motion_score(grey, grey, 0)
+    resize4_bgr2grey(numpy.zeros((4, 4, 3), dtype=numpy.uint8), grey)
@@ -1,13 +1,115 @@
 """ Anything related to OpenCV's camera device. """
 
-from typing import Any, List
+from typing import Any, Dict, List, Tuple
 
 import cv2
-import imutils
 import numpy
 
+from . import _kernels
 from .exceptions import NoFrame
 
+# Kernel sizes for each kind of blur. An 11x11 box blur smooths about as much
+# as the 21x21 Gaussian blur, for a fraction of the work.
+BLUR_KERNELS = {
+    "box": (11, 11),
+    "gaussian": (21, 21),
+}
+
+# `_count_regions` dilates twice with a 3x3 kernel, which grows each changed
+# pixel into at most a 5x5 square. A region can't cover more pixels than this
+# for each changed pixel inside it.
+MAX_REGION_GROWTH = 25
+
+
+def _blur(
+    image: numpy.ndarray,
+    kind: str,
+    dst: numpy.ndarray = None
+) -> numpy.ndarray:
+    """
+    Blur an image with one of the kernels from `BLUR_KERNELS`.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        the image to blur.
+
+    kind : str
+        the kind of blur, either "box" or "gaussian".
+
+    dst : numpy.ndarray
+        optional buffer to write the blurred image into.
+
+    Returns
+    -------
+    numpy.ndarray
+        the blurred image.
+    """
+    if kind not in BLUR_KERNELS:
+        raise ValueError(f"Unknown blur kind {kind!r}.")
+
+    if kind == "box":
+        return cv2.blur(image, BLUR_KERNELS[kind], dst=dst)
+
+    return cv2.GaussianBlur(image, BLUR_KERNELS[kind], 0, dst=dst)
+
+
+def _count_regions(
+    current: numpy.ndarray,
+    reference: numpy.ndarray,
+    minimum_area: int,
+    buffers: Dict[str, numpy.ndarray] = None
+) -> int:
+    """
+    Count the regions of change between two images that cover at least the
+    minimum area. Works on the raw images and writes every intermediate image
+    into the given buffers, so no new arrays or `Frame` objects are made along
+    the way.
+
+    Uses the areas from `cv2.connectedComponentsWithStats`, which are measured
+    for every region at once, rather than finding contours and measuring them
+    one by one like `Frame.contours` does. A region's area is its pixel count,
+    so it comes out slightly larger than the area inside its contour.
+
+    Parameters
+    ----------
+    current : numpy.ndarray
+        the greyscale image to look for motion in.
+
+    reference : numpy.ndarray
+        the greyscale image to compare against.
+
+    minimum_area : int
+        minimum amount of pixels to have within a region for it to count
+        towards the count.
+
+    buffers : Dict[str, numpy.ndarray]
+        optional scratch buffers the same shape as the images, under the
+        "delta", "dilate" and "labels" keys. "labels" must be `numpy.int32`.
+        new arrays are made for any that are missing.
+
+    Returns
+    -------
+    int
+        the number of regions that match the parameters.
+    """
+    buffers = buffers or {}
+
+    delta = cv2.absdiff(current, reference, dst=buffers.get("delta"))
+    cv2.threshold(delta, 30, 255, cv2.THRESH_BINARY, dst=delta)
+    dilated = cv2.dilate(delta, None, dst=buffers.get("dilate"), iterations=2)
+
+    _, _, stats, _ = cv2.connectedComponentsWithStats(
+        dilated,
+        labels=buffers.get("labels"),
+        connectivity=8
+    )
+
+    # The first component is the background.
+    areas = stats[1:, cv2.CC_STAT_AREA]
+
+    return int(numpy.count_nonzero(areas >= minimum_area))
+
 
 class Frame:
     """ Singular frame from the camera. """
@@ -62,7 +164,7 @@ class Frame:
         """
         return Frame(self.data.copy())
 
-    def resize(self, new_size: int) -> Any:
+    def resize(self, new_size: int, dst: numpy.ndarray = None) -> Any:
         """
         Resize the frame to a given width.
 
@@ -71,14 +173,26 @@ class Frame:
         new_size : int
             width to resize the image to. height will be adjusted automatically.
 
+        dst : numpy.ndarray
+            optional buffer to write the resized image into.
+
         Returns
         -------
         catnip.Frame
             the resized image.
         """
-        return Frame(imutils.resize(self.data, width=new_size))
+        height = int(self.height * (new_size / float(self.width)))
+
+        return Frame(
+            cv2.resize(
+                self.data,
+                (new_size, height),
+                dst=dst,
+                interpolation=cv2.INTER_AREA
+            )
+        )
 
-    def recolor(self, new_color: int) -> Any:
+    def recolor(self, new_color: int, dst: numpy.ndarray = None) -> Any:
         """
         Recolour the frame into a given colour space. Use the following code
         example to list all available colour spaces.
@@ -96,25 +210,99 @@ class Frame:
         new_color : int
             OpenCV colour space, not a standard hex colour.
 
+        dst : numpy.ndarray
+            optional buffer to write the recoloured image into.
+
         Return
         ------
         catnip.Frame
             the recoloured frame.
         """
-        return Frame(cv2.cvtColor(self.data, new_color))
+        return Frame(cv2.cvtColor(self.data, new_color, dst=dst))
 
-    def blur(self) -> Any:
+    def blur(self, kind: str = "box", dst: numpy.ndarray = None) -> Any:
         """
         Blur the image.
 
+        Parameters
+        ----------
+        kind : str
+            the kind of blur, either "box" or "gaussian". the box blur costs the
+            same no matter the kernel size, and is much cheaper.
+
+        dst : numpy.ndarray
+            optional buffer to write the blurred image into.
+
         Returns
         -------
         catnip.Frame
             the blurred image.
         """
-        return Frame(cv2.GaussianBlur(self.data, (21, 21), 0))
+        return Frame(_blur(self.data, kind, dst=dst))
 
-    def delta(self, other_frame) -> Any:
+    def preprocess(
+        self,
+        size: Tuple[int, int],
+        dst_resized: numpy.ndarray = None,
+        dst_gray: numpy.ndarray = None,
+        dst_blur: numpy.ndarray = None,
+        blur_kind: str = "box"
+    ) -> Any:
+        """
+        Resize, greyscale and blur the frame in one go, ready for motion
+        detection. Equivalent to `frame.resize(width).recolor(
+        cv2.COLOR_BGR2GRAY).blur()`, but the size is given up front and the
+        intermediate images can be written into preallocated buffers instead of
+        new arrays.
+
+        Parameters
+        ----------
+        size : Tuple[int, int]
+            width and height to resize the image to.
+
+        dst_resized : numpy.ndarray
+            optional buffer to write the resized colour image into. isn't used
+            when resizing to exactly a quarter of the frame's size, if its
+            width and height are multiples of four.
+
+        dst_gray : numpy.ndarray
+            optional buffer to write the greyscale image into.
+
+        dst_blur : numpy.ndarray
+            optional buffer to write the blurred image into.
+
+        blur_kind : str
+            the kind of blur, either "box" or "gaussian".
+
+        Returns
+        -------
+        catnip.Frame
+            the processed frame, backed by `dst_blur` if it was given.
+        """
+        # Shrinking to exactly a quarter of the size is by far the most common
+        # case, and can be done in one pass without the resized colour image.
+        # Only when the size divides evenly though, otherwise the kernel would
+        # leave out the last few rows and columns.
+        exact = self.width % 4 == 0 and self.height % 4 == 0
+
+        if exact and size == (self.width // 4, self.height // 4):
+            if dst_gray is None:
+                dst_gray = numpy.empty((size[1], size[0]), dtype=numpy.uint8)
+
+            _kernels.resize4_bgr2grey(self._frame_data, dst_gray)
+            gray = dst_gray
+        else:
+            resized = cv2.resize(
+                self._frame_data,
+                size,
+                dst=dst_resized,
+                interpolation=cv2.INTER_AREA
+            )
+            gray = cv2.cvtColor(resized, cv2.COLOR_BGR2GRAY, dst=dst_gray)
+
+        return Frame(_blur(gray, blur_kind, dst=dst_blur))
+
+    def delta(self, other_frame: Any, dst: numpy.ndarray = None) -> Any:
         """
         Get the difference between two frames.
 
@@ -123,19 +311,23 @@ class Frame:
         other_frame : catnip.Frame
             the frame to create the delta with.
 
+        dst : numpy.ndarray
+            optional buffer to write the difference into.
+
         Returns
         -------
         catnip.Frame
             frame with the difference between the frames.
         """
-        return Frame(cv2.absdiff(self.data, other_frame.data))
+        return Frame(cv2.absdiff(self.data, other_frame.data, dst=dst))
 
     def threshold(
         self,
         other_frame: Any,
         threshold: int = 30,
         max_amount: int = 255,
-        function: int = cv2.THRESH_BINARY
+        function: int = cv2.THRESH_BINARY,
+        dst: numpy.ndarray = None
     ) -> Any:
         """
         Calculate the thresholded value of the frame deltas.
@@ -155,23 +347,67 @@ class Frame:
         function:
             the thresholding function to use.
 
+        dst : numpy.ndarray
+            optional buffer to write the thresholded image into. the delta is
+            written into the same buffer and thresholded in place.
+
         Returns
         -------
         catnip.Frame
             the thresholded frame.
         """
-        delta: Frame = self.delta(other_frame)
+        delta: Frame = self.delta(other_frame, dst=dst)
 
         _, threshold = cv2.threshold(
             delta.data,
             threshold,
             max_amount,
-            function
+            function,
+            dst=delta.data
         )
 
         return Frame(threshold)
 
-    def dilate(self, other_frame: Any, iterations: int = 2) -> Any:
+    def motion_score(self, other_frame: Any, threshold: int = 30) -> int:
+        """
+        Count how many pixels differ between two frames by more than the given
+        threshold. Much cheaper than `contours`, so it can be used to rule out
+        motion before running the full contour detection.
+
+        Parameters
+        ----------
+        other_frame : catnip.Frame
+            the frame to compare with.
+
+        threshold : int
+            how much a pixel has to change by to be counted.
+
+        Returns
+        -------
+        int
+            the number of changed pixels.
+        """
+        # The kernel only handles single-channel 8-bit images, and would
+        # otherwise fail with a much less helpful typing error.
+        for frame in (self, other_frame):
+            if frame.data.ndim != 2 or frame.data.dtype != numpy.uint8:
+                raise ValueError(
+                    "Frames must be greyscale uint8 images to be compared, not "
+                    f"{frame.data.dtype} images of shape {frame.data.shape}."
+                )
+
+        if self.data.shape != other_frame.data.shape:
+            raise ValueError("Frames must be the same shape to be compared.")
+
+        return _kernels.motion_score(self.data, other_frame.data, threshold)
+
+    def dilate(
+        self,
+        other_frame: Any,
+        iterations: int = 2,
+        dst: numpy.ndarray = None,
+        threshold_dst: numpy.ndarray = None
+    ) -> Any:
         """
         Diminish the features of the frame.
         * https://docs.opencv.org/3.4.15/db/df6/tutorial_erosion_dilatation.html
@@ -184,16 +420,30 @@ class Frame:
         iterations : int
             how many times the dilation should be done.
 
+        dst : numpy.ndarray
+            optional buffer to write the dilated image into.
+
+        threshold_dst : numpy.ndarray
+            optional buffer to write the intermediate thresholded image into.
+
         Returns
         -------
         catnip.Frame
             the dilated frame.
         """
-        threshold: Frame = self.threshold(other_frame)
+        threshold: Frame = self.threshold(other_frame, dst=threshold_dst)
 
-        return Frame(cv2.dilate(threshold.data, None, iterations=iterations))
+        return Frame(
+            cv2.dilate(threshold.data, None, dst=dst, iterations=iterations)
+        )
 
-    def contours(self, other_frame: Any, minimum_area: int = 2500) -> List[Any]:
+    def contours(
+        self,
+        other_frame: Any,
+        minimum_area: int = 2500,
+        dst: numpy.ndarray = None,
+        threshold_dst: numpy.ndarray = None
+    ) -> List[Any]:
         """
         Generate the contours between the given frames.
 
@@ -206,43 +456,88 @@ class Frame:
             minimum amount of pixels to have within a contour for it to count
             towards the count.
 
+        dst : numpy.ndarray
+            optional buffer to write the intermediate dilated image into.
+
+        threshold_dst : numpy.ndarray
+            optional buffer to write the intermediate thresholded image into.
+
         Returns
         -------
         List[Any]
             list of any contours that match the parameters.
         """
-        frame: Frame = self.dilate(other_frame)
+        frame: Frame = self.dilate(
+            other_frame,
+            dst=dst,
+            threshold_dst=threshold_dst
+        )
 
-        contours = cv2.findContours(
+        contours, _ = cv2.findContours(
             frame.data,
-            cv2.RETR_TREE,
+            cv2.RETR_EXTERNAL,
             cv2.CHAIN_APPROX_SIMPLE
         )
 
         return [
             contour
             for contour
-            in imutils.grab_contours(contours)
+            in contours
             if cv2.contourArea(contour) >= minimum_area
         ]
 
-    def is_similar(self, other_frame: Any) -> bool:
+    def is_similar(
+        self,
+        other_frame: Any,
+        minimum_area: int = 2500,
+        dst: numpy.ndarray = None,
+        threshold_dst: numpy.ndarray = None
+    ) -> bool:
         """
         Whether or not one frame is similar to another.
 
         Parameters
         ----------
         other_frame : catnip.Frame
-            the frame to compare contours with.
+            the frame to compare with.
+
+        minimum_area : int
+            minimum area of a region of change, in pixels, for the frames to
+            not be similar.
+
+        dst : numpy.ndarray
+            optional buffer to write the intermediate dilated image into.
+
+        threshold_dst : numpy.ndarray
+            optional buffer to write the intermediate thresholded image into.
 
         Returns
         -------
         bool
             whether or not the other frame is similar to the current one.
         """
-        return len(self.contours(other_frame)) == 0
+        # Even fully dilated, too few changed pixels to make up a region.
+        score = self.motion_score(other_frame)
+
+        if score * MAX_REGION_GROWTH < minimum_area:
+            return True
+
+        buffers = {"delta": threshold_dst, "dilate": dst}
+        regions = _count_regions(
+            self.data,
+            other_frame.data,
+            minimum_area,
+            buffers
+        )
 
-    def write(self, file_name: str, draw_text: List[str] = None) -> None:
+        return regions == 0
+
+    def write(
+        self,
+        file_name: str,
+        draw_text: List[str] = None,
+        in_place: bool = False
+    ) -> None:
         """
         Save the frame to an output file.
 
@@ -252,10 +547,16 @@ class Frame:
             the path to save the image to.
         draw_text : List[str]
             a list of strings to print on the frame.
+        in_place : bool
+            draw the text straight onto this frame instead of a copy of it.
+            saves copying the whole frame when it won't be used afterwards.
         """
-        frame = self._frame_data.copy()
+        frame = self._frame_data
 
         if draw_text is not None:
+            if not in_place:
+                frame = frame.copy()
+
             for idx, item in enumerate(draw_text, start=1):
                 cv2.putText(
                     img=frame,
@@ -323,7 +624,24 @@ class Camera(cv2.VideoCapture):
         catnip.Frame
             the current frame.
         """
-        received, frame = super().read()
+        return self.capture_into(None)
+
+    def capture_into(self, dst: numpy.ndarray) -> Frame:
+        """
+        Capture the current frame from the device into an existing buffer.
+
+        Parameters
+        ----------
+        dst : numpy.ndarray
+            buffer to write the frame into. a new array is made if it's `None`
+            or doesn't match the size of the frame.
+
+        Returns
+        -------
+        catnip.Frame
+            the current frame.
+        """
+        received, frame = super().read(dst)
 
         if not received:
             raise NoFrame(
@@ -1,13 +1,206 @@
 """ Functions to use when motion is detected. """
 
+import logging
 import os
+import queue
+import threading
 import time
 from datetime import datetime
+from typing import Any, Tuple
 
 import cv2
+import numpy
 
 from .camera import Frame
 
+log = logging.getLogger(__name__)
+
+# Codecs to try when opening a video writer, in order of preference. H.264 is
+# asked for with hardware acceleration (VA-API, Media SDK, etc.) where the
+# FFmpeg build supports it, otherwise the software `mp4v` encoder is used.
+WRITER_CODECS = [
+    (
+        "H264",
+        [cv2.VIDEOWRITER_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+    ),
+    ("mp4v", []),
+]
+
+# Index into `WRITER_CODECS` of the first codec that opened successfully, so
+# that codecs which aren't available are only tried once.
+_writer_codec = 0
+
+# How many frames an event can hold on to while they wait to be encoded, if
+# it isn't given a ring of buffers to use. about a second's worth for most
+# cameras.
+BUFFERED_FRAMES = 30
+
+# Whether to try encoding on an NVIDIA GPU first. Turned off the first time it
+# fails, e.g. when OpenCV wasn't built with `cudacodec` or there's no GPU.
+_use_cuda_writer = True
+
+
+class _CudaWriter:
+    """
+    Wraps a `cv2.cudacodec.VideoWriter` with the same methods as the
+    `cv2.VideoWriter` it stands in for, uploading each frame to the GPU before
+    it's encoded.
+
+    Attributes
+    ----------
+    writer : cv2.cudacodec.VideoWriter
+        the GPU video writer.
+
+    upload : cv2.cuda.GpuMat
+        GPU buffer frames are uploaded into, reused for every frame.
+    """
+
+    def __init__(self, writer: Any):
+        """
+        Parameters
+        ----------
+        writer : cv2.cudacodec.VideoWriter
+            the GPU video writer.
+        """
+        self.writer = writer
+        self.upload = cv2.cuda_GpuMat()
+
+    def isOpened(self) -> bool:
+        """
+        Whether or not the writer is open. `cv2.cudacodec.createVideoWriter`
+        raises an error rather than returning a closed writer, so it always is.
+
+        Returns
+        -------
+        bool
+            always `True`.
+        """
+        return True
+
+    def write(self, image: Any) -> None:
+        """
+        Upload a frame to the GPU and encode it.
+
+        Parameters
+        ----------
+        image : numpy.ndarray
+            the BGR frame to encode.
+        """
+        self.upload.upload(image)
+        self.writer.write(self.upload)
+
+    def release(self) -> None:
+        """ Finish encoding and close the file. """
+        self.writer.release()
+
+
+def _open_cuda_writer(file: str, fps: float, size: Tuple[int, int]) -> Any:
+    """
+    Open a video writer that encodes H.264 on the GPU with NVENC.
+
+    Parameters
+    ----------
+    file : str
+        the file to save the video to.
+
+    fps : float
+        frames per second of the video.
+
+    size : Tuple[int, int]
+        width and height of the video.
+
+    Returns
+    -------
+    catnip.event._CudaWriter
+        the opened video writer, or `None` if the GPU can't be used.
+    """
+    # Before OpenCV 4.8 the GPU writer either isn't implemented or only writes
+    # a raw H.264 stream, rather than the container the file name asks for.
+    version = tuple(int(part) for part in cv2.__version__.split(".")[:2])
+
+    cudacodec = getattr(cv2, "cudacodec", None)
+
+    if version < (4, 8) or cudacodec is None:
+        return None
+
+    # The signature and names of the GPU writer have changed between OpenCV
+    # versions, so anything unexpected just means it can't be used.
+    try:
+        if cv2.cuda.getCudaEnabledDeviceCount() == 0:
+            return None
+
+        writer = cudacodec.createVideoWriter(
+            file,
+            size,
+            codec=cudacodec.H264,
+            fps=fps,
+            colorFormat=cudacodec.COLOR_FORMAT_BGR
+        )
+    except (cv2.error, AttributeError, TypeError):
+        return None
+
+    return _CudaWriter(writer)
+
+
+def open_writer(file: str, fps: float, size: Tuple[int, int]) -> Any:
+    """
+    Open a video writer with the most preferred codec that's available,
+    encoding on the GPU if possible.
+
+    Parameters
+    ----------
+    file : str
+        the file to save the video to.
+
+    fps : float
+        frames per second of the video.
+
+    size : Tuple[int, int]
+        width and height of the video.
+
+    Returns
+    -------
+    cv2.VideoWriter
+        the opened video writer.
+    """
+    global _use_cuda_writer, _writer_codec
+
+    if _use_cuda_writer:
+        writer = _open_cuda_writer(file, fps, size)
+
+        if writer is not None:
+            return writer
+
+        log.debug("Can't encode recordings on the GPU, using the CPU instead.")
+        _use_cuda_writer = False
+
+    for idx in range(_writer_codec, len(WRITER_CODECS)):
+        codec, params = WRITER_CODECS[idx]
+        fourcc = cv2.VideoWriter_fourcc(*codec)
+
+        writer = cv2.VideoWriter(
+            file,
+            cv2.CAP_FFMPEG,
+            fourcc,
+            fps,
+            size,
+            params
+        )
+
+        if writer.isOpened():
+            if idx != _writer_codec:
+                # The standard library's logging only formats %-style
+                # arguments, whatever the format style pylint is set up for.
+                # pylint: disable-next=logging-too-many-args
+                log.info("Falling back to the %s codec for recordings.", codec)
+
+            _writer_codec = idx
+            return writer
+
+    # Leave it to OpenCV to pick a backend for the least preferred codec.
+    codec, _ = WRITER_CODECS[-1]
+    return cv2.VideoWriter(file, cv2.VideoWriter_fourcc(*codec), fps, size)
+
 
 class Event:
     """
@@ -17,40 +210,128 @@ class Event:
     As frames are fed to the event from the camera thread, they will be
     processed (timestamp and other text the user wants).
 
+    Frames are copied into a preallocated ring of buffers and encoded by a
+    thread of the event's own, so that the camera thread never has to wait
+    on the encoder unless it falls a whole ring behind.
+
     Attributes
     ----------
     trigger : catnip.Frame
         initial frame that triggered the motion event.
 
     updated : float
-        when the trigger frame was last updated.
+        when the trigger frame was last updated, from `time.monotonic`.
 
     file : str
         the file to save the video to.
+
+    writer_file : str
+        the file the video is being written to, which is moved to `file` when
+        the event is closed if it's different.
     
     writer : cv2.VideoWriter
-        cv2 video writer object to process frames into video.
+        cv2 video writer object to process frames into video. may be encoding
+        on the GPU, see `open_writer`.
     """
 
-    def __init__(self, trigger: Frame, path: str, width: int, height: int, fps: int):
+    def __init__(
+        self,
+        trigger: Frame,
+        path: str,
+        width: int,
+        height: int,
+        fps: int,
+        spare: Tuple[str, Any] = None,
+        ring: numpy.ndarray = None
+    ):
         """
         Parameters
         ----------
         trigger : catnip.Frame
             initial frame that triggered the motion event.
+
+        path : str
+            the folder to save the video in, which must already exist.
+
+        spare : Tuple[str, cv2.VideoWriter]
+            an already opened writer and the file it's writing to, to use
+            instead of opening a new one. the file must be on the same file
+            system as `path`.
+
+        ring : numpy.ndarray
+            buffers to hold frames in until they're encoded, with the shape
+            `(count, height, width, 3)`. can be reused for the next event once
+            this one is closed. `BUFFERED_FRAMES` new buffers if not given.
         """
         self.trigger: Frame = trigger
 
         self.start: datetime = datetime.now()
-        self.updated: float = time.time()
+        self.updated: float = time.monotonic()
 
         self.file = os.path.join(path, self.start.strftime("%H%M%S_%f.avi"))
 
-        if not os.path.isfile(path):
-            os.makedirs(path, exist_ok=True)
+        if spare is None:
+            self.writer_file = self.file
+            self.writer = open_writer(self.file, fps, (width, height))
+        else:
+            self.writer_file, self.writer = spare
+
+        if ring is None:
+            ring = numpy.empty(
+                (BUFFERED_FRAMES, height, width, 3),
+                dtype=numpy.uint8
+            )
+
+        self._ring = ring
+
+        # Indices into the ring. Free buffers are reused most recently freed
+        # first, so that a writer which keeps up only ever touches a couple of
+        # them rather than cycling through the whole ring.
+        self._free: queue.LifoQueue = queue.LifoQueue()
+        self._filled: queue.Queue = queue.Queue()
+
+        for idx in range(len(self._ring)):
+            self._free.put_nowait(idx)
+
+        # Stops frames from being added once the event is closed.
+        self._closed = False
+        self._closed_lock = threading.Lock()
+
+        # Whether `close` has already been called.
+        self._finished = False
+
+        # Daemonic so that an event that's never closed doesn't keep the
+        # process alive.
+        self._thread = threading.Thread(target=self._write_frames, daemon=True)
+        self._thread.start()
+
+    def _write_frames(self) -> None:
+        """ Encode frames from the ring as they're added, until closed. """
+        failed = False
+
+        while True:
+            idx = self._filled.get()
+
+            if idx is None:
+                break
+
+            # The buffer always has to go back, otherwise `add_frame` would
+            # eventually wait forever for a free one.
+            try:
+                if not failed:
+                    self.writer.write(self._ring[idx])
+            except Exception:  # pylint: disable=broad-except
+                # %-style, as that's all the standard library's logging takes.
+                # pylint: disable-next=logging-too-many-args
+                log.exception("Failed to write a frame to %s.", self.file)
+                failed = True
 
-        cc = cv2.VideoWriter_fourcc(*"mp4v")
-        self.writer = cv2.VideoWriter(self.file, cc, fps, (width, height))
+                # Stop taking frames, but keep giving back any buffers that
+                # were already filled.
+                with self._closed_lock:
+                    self._closed = True
+            finally:
+                self._free.put_nowait(idx)
 
     def should_update_trigger(self, delta: int = 10) -> bool:
         """
@@ -66,18 +347,62 @@ class Event:
         bool
             whether or not the trigger frame should be updated.
         """
-        return self.updated <= time.time() - delta
+        return self.updated <= time.monotonic() - delta
 
     def add_frame(self, frame: Frame) -> None:
         """
-        Save a frame to the event's video writer.
+        Save a frame to the event's video writer. The frame is copied, so its
+        buffer can be reused as soon as this returns.
 
         Parameters
         ----------
         frame : catnip.Frame
             frame to save to get the image from.
         """
-        self.writer.write(frame.data)
+        idx = self._free.get()
+
+        with self._closed_lock:
+            if self._closed:
+                self._free.put_nowait(idx)
+                return
+
+            numpy.copyto(self._ring[idx], frame.data)
+            self._filled.put_nowait(idx)
+
+    def close(self) -> None:
+        """
+        Finish writing the video, moving it into place if it was written with a
+        spare writer. Waits for any frames that haven't been encoded yet. Does
+        nothing if the event was already closed.
+
+        If the video can't be moved into place, it's left where it was written
+        and `file` is pointed at it instead.
+        """
+        if self._finished:
+            return
+
+        self._finished = True
+
+        with self._closed_lock:
+            self._closed = True
+            self._filled.put_nowait(None)
+
+        self._thread.join()
+        self.writer.release()
+
+        if self.writer_file == self.file:
+            return
+
+        try:
+            os.replace(self.writer_file, self.file)
+        except OSError:
+            # pylint: disable-next=logging-too-many-args
+            log.exception(
+                "Failed to move the recording %s to %s.",
+                self.writer_file,
+                self.file
+            )
+            self.file = self.writer_file
 
     def update_trigger(self, frame: Frame) -> None:
         """
@@ -89,4 +414,4 @@ class Event:
             frame to set the trigger to.
         """
         self.trigger = frame
-        self.updated = time.time()
+        self.updated = time.monotonic()
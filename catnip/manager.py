@@ -1,20 +1,33 @@
 """ A manager for the camera device to process the frames for motion events. """
 
+import glob
 import logging
 import os
+import queue
 import signal
 import threading
 import time
+import uuid
 from datetime import datetime
+from typing import Any, Callable, Tuple
 
 import cv2
+import numpy
 
-from . import util
-from .camera import Camera, Frame
-from .event import Event
+from . import _kernels, util
+from .camera import MAX_REGION_GROWTH, Camera, Frame, _count_regions
+from .event import Event, open_writer
 
 log = logging.getLogger(__name__)
 
+# How much each quiet frame moves the average frame towards itself.
+BACKGROUND_ALPHA = 0.05
+
+# Prefix of the temporary files that spare video writers are opened on. It's
+# followed by the id of the process that opened it, so that instances sharing
+# an output folder can tell their files apart.
+SPARE_WRITER_PREFIX = "_tmp_"
+
 
 class Manager:
     """
@@ -31,20 +44,27 @@ class Manager:
     detection_wait : float
         how long to wait between detection cycles.
 
+    minimum_area : int
+        minimum area of change, in pixels of the downscaled frame, before
+        motion is detected.
+
     camera : catnip.Camera
         the camera object.
 
     exit_event : threading.Event
         when the function's loops should be stopped.
 
-    latest_frame : catnip.Frame
-        the latest frame from the camera.
+    frame_queue : queue.Queue
+        hands the latest frame from the camera over to the preprocessing
+        thread. only ever holds the newest frame.
 
-    latest_frame_lock : threading.Lock
-        thread lock to activate when `latest_frame` is activated.
+    blur_queue : queue.Queue
+        hands blurred frames from the preprocessing thread over to the
+        detection thread.
 
     average_frame : catnip.Frame
-        the average to base comparisons with newer frames on.
+        a running average of recent quiet frames to base comparisons with newer
+        frames on.
 
     event : catnip.Event
         current motion event.
@@ -54,7 +74,8 @@ class Manager:
                  device_id: int = 0,
                  output_path: os.PathLike = None,
                  recording_length: float = 5.0,
-                 detection_wait: float = 1.0
+                 detection_wait: float = 1.0,
+                 minimum_area: int = 2500
                  ):
         """
         Parameters
@@ -67,38 +88,150 @@ class Manager:
 
         detection_wait : float
             how long to wait between detection cycles.
+
+        minimum_area : int
+            minimum area of change, in pixels of the downscaled frame, before
+            motion is detected.
         """
         self.device_id = device_id
         self.path = output_path if output_path else util.get_default_directory()
         self.recording_length = recording_length
         self.detection_wait = detection_wait
+        self.minimum_area = minimum_area
 
         self.camera = Camera(device_id)
 
+        # Leave a core for the recording thread and one for the preprocessing
+        # and detection threads, rather than letting OpenCV's own threads
+        # compete with them for every core. The optimised (SIMD) code paths are
+        # on by default, but can be turned off by the environment, so make
+        # sure of them here.
+        cv2.setUseOptimized(True)
+        cv2.setNumThreads(max(1, (os.cpu_count() or 1) - 2))
+
+        # The recording thread gets a core to itself so that it can keep up
+        # with the camera. The preprocessing and detection threads, and any
+        # threads they start for OpenCV or Numba, share the rest.
+        cpus = util.get_available_cpus()
+
+        if len(cpus) > 1:
+            self._record_cpus = {cpus[0]}
+            self._detect_cpus = set(cpus[1:])
+        else:
+            self._record_cpus = self._detect_cpus = None
+
         self.exit_event = threading.Event()
 
-        self.latest_frame: Frame = None
-        self.latest_frame_lock = threading.Lock()
+        self.frame_queue: queue.Queue = queue.Queue(maxsize=1)
+        self.blur_queue: queue.Queue = queue.Queue(maxsize=2)
+
+        # Buffers for the recording thread to capture into. At most one frame
+        # is being captured, one is waiting in `frame_queue` and one is being
+        # processed, so three is enough for them to never be allocated again.
+        # The preprocessing thread puts each buffer back once it's done with it.
+        # They're allocated along with the other buffers in `run`.
+        self._free_frames: queue.Queue = queue.Queue()
+
+        # Everything else that depends on the frame size, allocated in
+        # `_allocate_buffers`.
+        self._small_size: Tuple[int, int] = None
+        self._pool: dict = None
+        self._background: numpy.ndarray = None
+        self._average: numpy.ndarray = None
+        self._event_ring: numpy.ndarray = None
 
         self.average_frame: Frame = None
-        self.average_frame_lock = threading.Lock()
+
+        self._path_cache = (None, None)
+
+        # Opening a video writer can take a while, so one is kept open and
+        # ready for the next event, and replaced in the background whenever
+        # it's used.
+        self._spare_writers: queue.Queue = queue.Queue(maxsize=1)
+        self._spare_thread: threading.Thread = None
 
         self.event: Event = None
         self.callback_functions: dict = {}
 
+    def _allocate_buffers(self) -> None:
+        """
+        Allocate all of the buffers that depend on the camera's frame size, and
+        compile the kernels. Only done once the manager is run, as the size
+        isn't known if the camera couldn't be opened.
+        """
+        # Frames are only ever processed at a quarter of the camera's size, so
+        # work out the target size once rather than for every frame.
+        self._small_size = (self.camera.width // 4, self.camera.height // 4)
+
+        # Scratch buffers for the preprocessing and detection threads, reused
+        # every cycle instead of allocating new arrays for each step. Each
+        # buffer is only ever used by one of the threads.
+        small_shape = (self._small_size[1], self._small_size[0])
+        self._pool = {
+            name: numpy.empty(small_shape, dtype=numpy.uint8)
+            for name in ("gray", "delta", "dilate")
+        }
+        self._pool["labels"] = numpy.empty(small_shape, dtype=numpy.int32)
+        self._pool["resized"] = numpy.empty(
+            (*small_shape, 3),
+            dtype=numpy.uint8
+        )
+
+        # Buffers for the recording thread to capture into, see `_free_frames`.
+        for _ in range(3):
+            self._free_frames.put_nowait(
+                numpy.empty(
+                    (self.camera.height, self.camera.width, 3),
+                    dtype=numpy.uint8
+                )
+            )
+
+        # The running average is kept at full precision, and converted into
+        # the `average_frame` buffer whenever it changes.
+        self._background = numpy.zeros(small_shape, dtype=numpy.float32)
+        self._average = numpy.empty(small_shape, dtype=numpy.uint8)
+
+        # Buffers for events to hold frames in until they're encoded, about a
+        # second's worth. Only one event records at a time, so they're shared.
+        ring_frames = max(2, int(self.camera.fps))
+        self._event_ring = numpy.empty(
+            (ring_frames, self.camera.height, self.camera.width, 3),
+            dtype=numpy.uint8
+        )
+
+        # Compile the kernels now rather than on the first frames.
+        _kernels.warm_up()
+
     def _update_average_frame(self, frame: Frame) -> None:
         """
-        Update the average frame.
+        Reset the average frame, forgetting any frames before this one.
 
         Parameters
         ----------
         frame : catnip.Frame
             the _blurred_ frame to set the average frame to.
         """
-        with self.average_frame_lock:
-            self.average_frame = frame
+        numpy.copyto(self._background, frame.data)
+        numpy.copyto(self._average, frame.data)
+
+        # Only the detection thread uses the average, so none of this needs a
+        # lock.
+        self.average_frame = Frame(self._average)
 
         log.debug("Updated the average frame.")
+
+    def _accumulate_average_frame(self, frame: Frame) -> None:
+        """
+        Move the average frame slightly towards a quiet frame, so that it keeps
+        up with gradual changes such as the lighting.
+
+        Parameters
+        ----------
+        frame : catnip.Frame
+            the _blurred_ frame to add to the average.
+        """
+        cv2.accumulateWeighted(frame.data, self._background, BACKGROUND_ALPHA)
+        cv2.convertScaleAbs(self._background, dst=self._average)
     
     def _create_event(self, frame: Frame) -> Event:
         """
@@ -115,9 +248,133 @@ class Manager:
             newly created event.
         """
         now = datetime.now()
-        path = os.path.join(self.path, str(now.year), str(now.month), str(now.day))
+        day, path = self._path_cache
+
+        # Events are saved into a folder for each day, which only needs to be
+        # worked out and created once for all of the day's events.
+        if day != now.date():
+            day = now.date()
+            path = os.path.join(
+                self.path,
+                str(day.year),
+                str(day.month),
+                str(day.day)
+            )
+
+            os.makedirs(path, exist_ok=True)
+            self._path_cache = (day, path)
+
+        try:
+            spare = self._spare_writers.get_nowait()
+        except queue.Empty:
+            # The spare is either still being opened or couldn't be, so let
+            # the event open its own writer.
+            spare = None
+
+        # Open the next spare, unless one is still being opened.
+        if self._spare_thread is None or not self._spare_thread.is_alive():
+            self._prepare_spare_writer()
+
+        return Event(
+            frame,
+            path,
+            self.camera.width,
+            self.camera.height,
+            self.camera.fps,
+            spare=spare,
+            ring=self._event_ring
+        )
+
+    def _open_spare_writer(self) -> Tuple[str, Any]:
+        """
+        Open a video writer to a temporary file in the output folder, ready to
+        be given to the next event.
+
+        Returns
+        -------
+        Tuple[str, cv2.VideoWriter]
+            the temporary file and the writer.
+        """
+        os.makedirs(self.path, exist_ok=True)
+
+        name = f"{SPARE_WRITER_PREFIX}{os.getpid()}_{uuid.uuid4().hex}.avi"
+        file = os.path.join(self.path, name)
+        size = (self.camera.width, self.camera.height)
+
+        return file, open_writer(file, self.camera.fps, size)
+
+    def _prepare_spare_writer(self) -> None:
+        """ Open the next spare video writer in a background thread. """
+        def _prepare():
+            try:
+                file, writer = self._open_spare_writer()
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Failed to open a spare video writer.")
+                return
+
+            if writer.isOpened():
+                try:
+                    self._spare_writers.put_nowait((file, writer))
+                    return
+                except queue.Full:
+                    # Another thread got a spare in first, so this one isn't
+                    # needed.
+                    pass
+            else:
+                # Leave events to open their own writers if it didn't work.
+                log.warning("Failed to open a spare video writer.")
+
+            writer.release()
+            self._remove_spare_file(file)
+
+        self._spare_thread = threading.Thread(target=_prepare, daemon=True)
+        self._spare_thread.start()
+
+    def _remove_spare_file(self, file: str) -> None:
+        """
+        Remove a spare video writer's temporary file, if it was created.
+
+        Parameters
+        ----------
+        file : str
+            the temporary file.
+        """
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+
+    def _remove_stale_spare_files(self) -> None:
+        """
+        Remove any temporary files left behind by spare video writers from a
+        run that didn't shut down cleanly. Other instances may be using the
+        same output folder, so only files from processes that have since
+        stopped are removed.
+        """
+        pattern = os.path.join(self.path, SPARE_WRITER_PREFIX + "*_*.avi")
+
+        for file in glob.glob(pattern):
+            name = os.path.basename(file)[len(SPARE_WRITER_PREFIX):]
+
+            try:
+                pid = int(name.split("_", 1)[0])
+            except ValueError:
+                continue
+
+            # Windows can't check on a process this way, but won't remove a
+            # file that's still open either, so spares that are in use are
+            # left alone there too.
+            if os.name != "nt" and util.is_process_running(pid):
+                continue
+
+            # %-style, as that's all the standard library's logging takes.
+            # pylint: disable-next=logging-too-many-args
+            log.debug("Removing stale spare video file %s.", file)
 
-        return Event(frame, path, self.camera.width, self.camera.height, self.camera.fps)
+            try:
+                self._remove_spare_file(file)
+            except PermissionError:
+                continue
     
     def _do_callback(self, name: str, *args, **kwargs):
         """
@@ -149,86 +406,227 @@ class Manager:
 
         return _on
 
-    def detect(self) -> None:
-        """ Process the latest frame to check for any movement. """
-        while self.latest_frame is None:
-            time.sleep(0.1)
+    def _wait_for_next_cycle(self, start: float) -> None:
+        """
+        Wait until the next detection cycle is due.
 
-        while not self.exit_event.is_set():
-            start = time.time()
+        Parameters
+        ----------
+        start : float
+            when the current cycle started.
+        """
+        dur = time.monotonic() - start
+
+        # Wait on the exit event rather than sleeping so that shutting down
+        # doesn't have to wait for the rest of the cycle.
+        self.exit_event.wait(
+            (self.detection_wait - dur)
+            if dur <= self.detection_wait
+            else self.detection_wait
+        )
+
+    def _hand_over(
+        self,
+        handoff: queue.Queue,
+        item: Any,
+        release: Callable[[Any], None] = None
+    ) -> None:
+        """
+        Hand an item over to the next stage of the pipeline, dropping the
+        oldest item waiting in the queue if it's full.
 
-            if self.average_frame is None:
-                continue
+        Parameters
+        ----------
+        handoff : queue.Queue
+            the queue to the next stage.
 
-            with self.latest_frame_lock:
-                frame: Frame = self.latest_frame.copy()
+        item : Any
+            the item to hand over, or `None` to tell the next stage that no
+            more items are coming.
 
-            resized: Frame = frame.resize(frame.width // 4)
-            grey: Frame = resized.recolor(cv2.COLOR_BGR2GRAY)
-            blur: Frame = grey.blur()
+        release : Callable[[Any], None]
+            called with any item that gets dropped.
+        """
+        # Each queue only has the one producer, so once an item has been
+        # dropped there's guaranteed to be space for the new one.
+        if handoff.full():
+            try:
+                dropped = handoff.get_nowait()
+            except queue.Empty:
+                dropped = None
 
-            contours = blur.contours(self.average_frame)
+            if release is not None and dropped is not None:
+                release(dropped)
 
-            if self.event:
-                if self.event.should_update_trigger(self.recording_length):
-                    if not self.event.trigger.is_similar(blur):
-                        self.event.update_trigger(blur)
-                        continue
+        handoff.put_nowait(item)
 
-                    self.event.writer.release()
+    def _release_frame(self, frame: Frame) -> None:
+        """
+        Give a frame's buffer back to the recording thread to capture into.
 
-                    self._do_callback("event_end", self.event)
-                    self._update_average_frame(blur)
+        Parameters
+        ----------
+        frame : catnip.Frame
+            the frame that's no longer needed.
+        """
+        self._free_frames.put_nowait(frame.data)
 
-                    log.info("Finished recording a motion event.")
-                    self.event = None
+    def preprocess(self) -> None:
+        """
+        Take the latest frame from the camera every detection cycle, shrink it
+        down and hand it over to the detection thread through `blur_queue`.
+        """
+        util.pin_current_thread(self._detect_cpus)
+
+        try:
+            while not self.exit_event.is_set():
+                start = time.monotonic()
+
+                # The recording thread won't capture into this frame's buffer
+                # again until it's released, so it can be used without copying.
+                frame: Frame = self.frame_queue.get()
+
+                if frame is None:
+                    break
+
+                # The blurred frame is owned by the detection thread, which
+                # may keep it, so it can't live in a reused buffer.
+                try:
+                    blur: Frame = frame.preprocess(
+                        self._small_size,
+                        dst_resized=self._pool["resized"],
+                        dst_gray=self._pool["gray"],
+                    )
+                finally:
+                    self._release_frame(frame)
+
+                self._hand_over(self.blur_queue, blur)
+
+                self._wait_for_next_cycle(start)
+        finally:
+            self.exit_event.set()
+            self._hand_over(self.blur_queue, None)
 
-            elif len(contours) > 0:
-                self.event = self._create_event(blur)
-                self._do_callback("event_start", self.event)
+    def detect(self) -> None:
+        """ Process the latest blurred frame to check for any movement. """
+        util.pin_current_thread(self._detect_cpus)
 
-                log.info("Started recording a motion event.")
+        try:
+            while True:
+                blur = self.blur_queue.get()
 
-            end = time.time()
-            dur = end - start
+                if blur is None:
+                    break
 
-            time.sleep(
-                (self.detection_wait - dur)
-                if dur <= self.detection_wait
-                else self.detection_wait
+                self._detect_frame(blur)
+        finally:
+            self.exit_event.set()
+
+    def _detect_frame(self, blur: Frame) -> None:
+        """
+        Check a single frame for movement, starting or finishing events.
+
+        Parameters
+        ----------
+        blur : catnip.Frame
+            the frame, shrunk down and blurred.
+        """
+        # The average is seeded from the first frame to come through.
+        if self.average_frame is None:
+            self._update_average_frame(blur)
+            return
+
+        if self.event:
+            if self.event.should_update_trigger(self.recording_length):
+                similar = self.event.trigger.is_similar(
+                    blur,
+                    minimum_area=self.minimum_area,
+                    dst=self._pool["dilate"],
+                    threshold_dst=self._pool["delta"],
+                )
+
+                if not similar:
+                    self.event.update_trigger(blur)
+                    return
+
+                # Let go of the event first, so that it isn't closed again
+                # on shutdown if closing it fails.
+                event, self.event = self.event, None
+                event.close()
+
+                self._do_callback("event_end", event)
+                self._update_average_frame(blur)
+
+                log.info("Finished recording a motion event.")
+
+            return
+
+        # Comparing against the average only matters for starting a new
+        # event, so it's skipped entirely while one is being recorded.
+        # Frames with too few changed pixels to make up a region of the
+        # minimum area, even once they're dilated, are treated as idle without
+        # running the much more expensive region detection.
+        score = blur.motion_score(self.average_frame)
+
+        if score * MAX_REGION_GROWTH < self.minimum_area:
+            regions = 0
+        else:
+            regions = _count_regions(
+                blur.data,
+                self.average_frame.data,
+                self.minimum_area,
+                self._pool,
             )
 
+        if regions > 0:
+            self.event = self._create_event(blur)
+            self._do_callback("event_start", self.event)
+
+            log.info("Started recording a motion event.")
+        else:
+            self._accumulate_average_frame(blur)
+
     def record(self) -> None:
         """
-        Record footage from the camera constantly, saving the latest frame to
-        the `latest_frame` value. Before accessing it, the `latest_frame_lock`
-        lock should be acquired.
+        Record footage from the camera constantly, handing the latest frame
+        over to the preprocessing thread through `frame_queue`. Any frame the
+        preprocessing thread hasn't picked up yet is replaced.
         """
-        while not self.exit_event.is_set():
-            frame: Frame = self.camera.capture()
+        util.pin_current_thread(self._record_cpus)
 
-            with self.latest_frame_lock:
-                self.latest_frame = frame
+        try:
+            while not self.exit_event.is_set():
+                try:
+                    buffer = self._free_frames.get_nowait()
+                except queue.Empty:
+                    buffer = None
 
-            if self.average_frame is None:
-                resized: Frame = frame.resize(frame.width // 4)
-                grey: Frame = resized.recolor(cv2.COLOR_BGR2GRAY)
-                blur: Frame = grey.blur()
+                frame: Frame = self.camera.capture_into(buffer)
 
-                self._update_average_frame(blur)
+                self._hand_over(self.frame_queue, frame, self._release_frame)
 
-                continue
+                # The detection thread can end the event at any moment, so
+                # only look it up once. Adding a frame to a closed event is
+                # harmless.
+                event = self.event
 
-            if self.event is None:
-                continue
+                if event is None:
+                    continue
 
-            self.event.add_frame(frame)
+                event.add_frame(frame)
+        finally:
+            # Wake the other threads up so that they stop as well, even if the
+            # camera stopped giving frames.
+            self.exit_event.set()
+            self._hand_over(self.frame_queue, None, self._release_frame)
 
     def run(self) -> None:
         """
         Start all of the manager's required functions as threads.
         """
-        targets = [self.record, self.detect]
+        self._allocate_buffers()
+
+        targets = [self.record, self.preprocess, self.detect]
 
         def signal_handler(*_, **__):
             log.warning("Received a keyboard interrupt, shutting down...")
@@ -239,14 +637,24 @@ class Manager:
 
         threads = [threading.Thread(target=t, args=()) for t in targets]
 
+        self._remove_stale_spare_files()
+        self._prepare_spare_writer()
+
         for thread in threads:
             thread.start()
 
         log.info("Started the manager.")
 
+        # Every thread sets the exit event when it stops, for whatever reason,
+        # so there's no need to poll them. Windows only delivers the signal to
+        # the main thread between waits though, so wake up every so often.
+        timeout = 1 if os.name == "nt" else None
+
+        while not self.exit_event.wait(timeout):
+            pass
+
         for thread in threads:
-            while thread.is_alive():
-                thread.join(1)
+            thread.join()
 
         self.shutdown()
 
@@ -254,5 +662,26 @@ class Manager:
         """
         Graceful shutdown.
         """
+        # Finish off any event that was still recording. The camera still has
+        # to be released if that fails.
+        event, self.event = self.event, None
+
+        if event is not None:
+            try:
+                event.close()
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Failed to finish the last motion event.")
+
+        if self._spare_thread is not None:
+            self._spare_thread.join()
+
+        try:
+            file, writer = self._spare_writers.get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            writer.release()
+            self._remove_spare_file(file)
+
         self.camera.release()
         log.debug("Shut down gracefully.")
@@ -2,7 +2,10 @@
 
 import os
 import platform
+from functools import lru_cache
+from typing import List, Set
 
+@lru_cache(maxsize=1)
 def get_default_directory():
     system = platform.system()
 
@@ -15,7 +18,65 @@ def get_default_directory():
     else:
         path = os.path.join(os.getcwd(), "appdata")
     
-    if not os.path.isdir(path):
-        os.makedirs(path, exist_ok=True)
-    
+    os.makedirs(path, exist_ok=True)
+
     return path
+
+
+def get_available_cpus() -> List[int]:
+    """
+    Get the CPUs the process is allowed to run on.
+
+    Returns
+    -------
+    List[int]
+        the ids of the CPUs, in order. empty if the platform doesn't support
+        setting thread affinity.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return []
+
+    return sorted(os.sched_getaffinity(0))
+
+
+def pin_current_thread(cpus: Set[int]) -> None:
+    """
+    Restrict the calling thread to the given CPUs. Any threads it starts
+    afterwards, such as OpenCV's worker threads, inherit the same CPUs. A no-op
+    on platforms without thread affinity support.
+
+    Parameters
+    ----------
+    cpus : Set[int]
+        the ids of the CPUs to run on.
+    """
+    if not cpus or not hasattr(os, "sched_setaffinity"):
+        return
+
+    os.sched_setaffinity(0, cpus)
+
+
+def is_process_running(pid: int) -> bool:
+    """
+    Whether or not a process is still running. Only supported on POSIX, as
+    `os.kill` would terminate the process on Windows rather than check it.
+
+    Parameters
+    ----------
+    pid : int
+        the id of the process.
+
+    Returns
+    -------
+    bool
+        whether or not the process is running, including when it belongs to
+        another user.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True